@@ -1,7 +1,10 @@
 import requests
+import urllib3
 import sys
 import os
-from datetime import datetime, timezone # Added timezone
+import ipaddress
+import zlib
+import time
 
 # --- Configuration ---
 TARGET_ASNS_PRIMARY = {4134, 56040}  # AS4134 (Chinanet), AS56040 (China Mobile)
@@ -10,6 +13,9 @@ TARGET_ASNS_SECONDARY = {4134, 9808, 4837, 4808, 4812, 56040}
 BGP_TABLE_URL = "https://bgp.tools/table.txt"
 OUTPUT_FILENAME_PRIMARY = "cn_as4134_as56040_ipv4.txt"
 OUTPUT_FILENAME_SECONDARY = "cn_other_asns_ipv4.txt"
+# HTTP validators from the last successful fetch, used for conditional requests
+ETAG_FILENAME = "etag.txt"
+LAST_MODIFIED_FILENAME = "last-modified.txt"
 
 # --- CRITICAL CONFIGURATION ---
 # User-Agent set according to user request.
@@ -17,66 +23,145 @@ OUTPUT_FILENAME_SECONDARY = "cn_other_asns_ipv4.txt"
 USER_AGENT = "GitHubAction-CNIPFilter/1.0 (https://github.com/teishahbc/bgp-cn-ip; mailto:no@thankyou.com)"
 # --- End Configuration ---
 
-def is_ipv4_cidr(cidr_string):
-    """Checks if a CIDR string looks like IPv4 (contains a period and no colon)."""
-    return '.' in cidr_string and ':' not in cidr_string
+def iter_response_blocks(response, chunk_size=1 << 20):
+    """Yields lists of raw lines from a streamed response, decompressing gzip bodies chunk by chunk."""
+    # Read undecoded bytes so decompression overlaps with the download instead of urllib3 doing it
+    is_gzip = 'gzip' in response.headers.get('Content-Encoding', '').lower()
+    decompressor = zlib.decompressobj(31) if is_gzip else None # wbits=31 -> gzip container
+    buffer = bytearray()
+    while True:
+        chunk = response.raw.read(chunk_size, decode_content=False)
+        if not chunk:
+            break
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+        buffer += chunk
+        # Split everything up to the last newline in one C-level pass, keep the partial tail
+        last_newline = buffer.rfind(b'\n')
+        if last_newline < 0:
+            continue
+        yield bytes(buffer[:last_newline]).splitlines()
+        del buffer[:last_newline + 1]
+    if decompressor is not None:
+        buffer += decompressor.flush()
+        # A connection closed early without Content-Length ends mid-stream; don't emit a partial table
+        if not decompressor.eof:
+            raise zlib.error("gzip stream ended before the end-of-stream marker (truncated response)")
+    # Emit any trailing lines left once the stream is exhausted
+    yield bytes(buffer).splitlines()
 
-def fetch_and_filter(target_asns):
-    """Fetches bgp.tools table.txt data and filters for target ASNs/IPv4."""
+def read_validator(filename):
+    """Returns the stored HTTP validator in filename, or None if it is missing or empty."""
+    try:
+        with open(filename, 'r', encoding='utf-8') as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+def write_validator(filename, value):
+    """Stores an HTTP validator for the next run; a missing value removes any stale file."""
+    try:
+        if value:
+            with open(filename, 'w', encoding='utf-8') as f:
+                f.write(f"{value}\n")
+        elif os.path.exists(filename):
+            os.remove(filename)
+    except OSError as e:
+        # Not fatal: the next run just falls back to an unconditional download
+        print(f"Warning: Could not update {filename}: {e}", file=sys.stderr)
+
+def pack_ipv4_cidr(cidr_bytes):
+    """Packs an IPv4 CIDR like b'1.2.3.0/24' into one int: (address << 8) | prefix length.
+
+    Raises ValueError for anything that isn't a strict dotted-quad network (including host bits set).
+    """
+    network = ipaddress.IPv4Network(cidr_bytes.decode('ascii'))
+    return int(network.network_address) << 8 | network.prefixlen
+
+def filter_lines(lines, asn_tokens, filtered_cidrs):
+    """Adds target-ASN IPv4 CIDRs from raw table lines to filtered_cidrs as packed ints.
+
+    This is the hot loop over every row of the table, so it runs over whole blocks with
+    method lookups hoisted into locals. Returns the number of non-empty lines seen.
+    """
+    lookup_asn = asn_tokens.get
+    processed_lines = 0
+    for line_bytes in lines:
+        if not line_bytes:
+            continue
+        processed_lines += 1
+        # Skip comments on the raw bytes, before any split or decode
+        if line_bytes[0] == 0x23: # b'#'
+            continue
+        # Only the first two columns matter; stop splitting after them
+        parts = line_bytes.split(None, 2)
+        if len(parts) < 2:
+            continue
+        # Rows for other ASNs (and non-numeric ASN columns) simply miss the lookup
+        asn = lookup_asn(parts[1])
+        if asn is None:
+            continue
+        # IPv4 CIDRs contain a period and no colon
+        if b'.' not in parts[0] or b':' in parts[0]:
+            continue
+        try:
+            # Packed ints are compact and cheap to hash; merging unpacks the unique survivors
+            filtered_cidrs[asn].add(pack_ipv4_cidr(parts[0]))
+        except Exception as e:
+            # Catch other potential errors during line processing (e.g., malformed CIDRs)
+            print(f"Warning: Error processing line: {line_bytes.decode('utf-8', errors='ignore')}: {e}", file=sys.stderr)
+    return processed_lines
+
+def fetch_and_filter(target_asns, conditional=True):
+    """Fetches bgp.tools table.txt data once and returns matching IPv4 CIDRs keyed by ASN.
+
+    Returns a (cidrs_by_asn, validators) tuple, where validators holds the response's
+    ETag/Last-Modified headers. If conditional is set and the server replies 304 Not
+    Modified, returns (None, None).
+    """
     print(f"Fetching data from {BGP_TABLE_URL} for ASNs: {target_asns}...")
     # Use the configured User-Agent
-    headers = {'User-Agent': USER_AGENT}
-    filtered_cidrs = set() # Use a set to avoid duplicates
+    headers = {'User-Agent': USER_AGENT, 'Accept-Encoding': 'gzip'}
+    if conditional:
+        etag = read_validator(ETAG_FILENAME)
+        last_modified = read_validator(LAST_MODIFIED_FILENAME)
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+    filtered_cidrs = {asn: set() for asn in target_asns} # Per-ASN sets of packed CIDRs to avoid duplicates
+    # Map each target ASN's decimal byte string to the ASN, so the ASN column is matched
+    # exactly with one dict lookup instead of decoding and int()-parsing every row
+    asn_tokens = {str(asn).encode(): asn for asn in target_asns}
 
     try:
         # Increased timeout slightly, added stream=True for memory efficiency
         response = requests.get(BGP_TABLE_URL, headers=headers, timeout=180, stream=True)
         response.raise_for_status()
         print(f"HTTP Status Code: {response.status_code}")
+        if response.status_code == 304:
+            response.close()
+            print("BGP table not modified since the last run.")
+            return None, None
+        validators = {
+            ETAG_FILENAME: response.headers.get('ETag'),
+            LAST_MODIFIED_FILENAME: response.headers.get('Last-Modified'),
+        }
 
         print("Processing data...")
         processed_lines = 0
-        # Process line by line using iter_lines for large files
-        for line_bytes in response.iter_lines():
-            if line_bytes:
-                processed_lines += 1
-                try:
-                    # Decode from bytes, strip leading/trailing whitespace
-                    line = line_bytes.decode('utf-8').strip()
-                    # Skip empty lines or comments
-                    if not line or line.startswith('#'):
-                        continue
-
-                    parts = line.split()
-                    if len(parts) >= 2:
-                        cidr = parts[0]
-                        asn_str = parts[1]
-                        try:
-                            asn = int(asn_str)
-                        except ValueError:
-                            # Log only first few errors to avoid spamming logs
-                            if processed_lines < 100 and len(filtered_cidrs) < 10:
-                                print(f"Warning: Could not parse ASN '{asn_str}' from line: {line}", file=sys.stderr)
-                            continue # Skip this line if ASN is not an integer
-
-                        # Check if the ASN is in our target list and the CIDR looks like IPv4
-                        if asn in target_asns and is_ipv4_cidr(cidr):
-                            filtered_cidrs.add(cidr)
-                    else:
-                        # Log only first few errors for malformed lines
-                        if processed_lines < 100 and len(filtered_cidrs) < 10:
-                             print(f"Warning: Unexpected line format: {line}", file=sys.stderr)
-
-                    # Provide progress update periodically
-                    if processed_lines % 100000 == 0:
-                         print(f"  Processed {processed_lines} lines...")
-
-                except Exception as e:
-                    # Catch other potential errors during line processing (e.g., decoding errors)
-                    print(f"Warning: Error processing line: {line_bytes.decode('utf-8', errors='ignore')}: {e}", file=sys.stderr)
+        next_progress = 100000
+        # Process a block of lines at a time while the body is still downloading/decompressing
+        for lines in iter_response_blocks(response):
+            processed_lines += filter_lines(lines, asn_tokens, filtered_cidrs)
+            # Provide progress update periodically
+            if processed_lines >= next_progress:
+                print(f"  Processed {processed_lines} lines...")
+                next_progress = (processed_lines // 100000 + 1) * 100000
 
         print(f"Finished processing {processed_lines} lines.")
-        print(f"Found {len(filtered_cidrs)} unique matching IPv4 CIDRs for ASNs {target_asns}.")
+        for asn in sorted(filtered_cidrs):
+            print(f"  AS{asn}: {len(filtered_cidrs[asn])} unique IPv4 CIDRs")
 
     except requests.exceptions.RequestException as e:
         print(f"Fatal: Error fetching data from {BGP_TABLE_URL}: {e}", file=sys.stderr)
@@ -86,24 +171,76 @@ def fetch_and_filter(target_asns):
              if e.response.status_code == 403:
                   print("Fatal: Received 403 Forbidden. This might be due to the User-Agent or excessive requests.", file=sys.stderr)
         sys.exit(1) # Exit with error code if fetch fails
+    except (urllib3.exceptions.HTTPError, zlib.error) as e:
+        # Reading response.raw bypasses requests' exception wrapping, so dropped connections,
+        # read timeouts and corrupt gzip bodies surface as urllib3/zlib errors instead
+        print(f"Fatal: Error fetching data from {BGP_TABLE_URL}: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    # Return the found CIDRs per ASN; ordering is applied when the lists are merged
+    return filtered_cidrs, validators
 
-    # Return the found CIDRs as a sorted list
-    return sorted(list(filtered_cidrs))
+def merge_asn_cidrs(cidrs_by_asn, target_asns):
+    """Combines the per-ASN results of fetch_and_filter into one aggregated list for target_asns."""
+    networks = []
+    for asn in target_asns:
+        # Packed values were validated by pack_ipv4_cidr, so unpacking can't fail
+        for packed in cidrs_by_asn.get(asn, ()):
+            networks.append(ipaddress.IPv4Network((packed >> 8, packed & 0xFF)))
+    # Merge overlapping/adjacent prefixes; IPv4Network sorts numerically, unlike the strings
+    return [str(network) for network in sorted(ipaddress.collapse_addresses(networks))]
+
+TIMESTAMP_PREFIX = "# Last updated: "
+
+def asn_header(target_asns):
+    """Returns the first header line of an output file, naming its ASNs in sorted order."""
+    return f"# IPv4 CIDRs for ASNs {', '.join(map(str, sorted(list(target_asns))))}\n"
+
+def output_is_current(filename, target_asns):
+    """Checks that filename exists and was generated for exactly target_asns."""
+    try:
+        with open(filename, 'r', encoding='utf-8') as f:
+            return f.readline() == asn_header(target_asns)
+    except (IOError, UnicodeDecodeError):
+        return False
+
+def without_timestamp(content):
+    """Returns file content with the '# Last updated' header line removed, for comparisons."""
+    return ''.join(line for line in content.splitlines(keepends=True) if not line.startswith(TIMESTAMP_PREFIX))
 
 def write_output(cidrs, filename, target_asns):
-    """Writes the list of CIDRs to the output file with headers."""
+    """Writes the list of CIDRs to the output file with headers, unless only the timestamp would change.
+
+    Returns True if the file was written, False if it was left unchanged.
+    """
+    header = asn_header(target_asns)
+    header += f"# Data sourced from bgp.tools ({BGP_TABLE_URL})\n"
+    # One joined string instead of a formatted write per CIDR
+    body = "# WARNING: ASN Geo-location is not always precise. This list is based on ASN registration only.\n"
+    body += "#-----------------------------------------------------------\n"
+    if cidrs:
+        body += '\n'.join(cidrs) + '\n'
+
+    # Leave the file (and its timestamp) alone when the list itself hasn't changed
+    try:
+        with open(filename, 'r', encoding='utf-8') as f:
+            if without_timestamp(f.read()) == header + body:
+                print(f"{filename} unchanged, skipping write.")
+                return False
+    except FileNotFoundError:
+        pass
+    except (IOError, UnicodeDecodeError) as e:
+        print(f"Warning: Could not read existing {filename}, rewriting it: {e}", file=sys.stderr)
+
     print(f"Writing {len(cidrs)} CIDRs to {filename}...")
     try:
         with open(filename, 'w', encoding='utf-8') as f: # Specify encoding
-            f.write(f"# IPv4 CIDRs for ASNs {', '.join(map(str, sorted(list(target_asns))))}\n") # Sort ASNs in header
-            f.write(f"# Data sourced from bgp.tools ({BGP_TABLE_URL})\n")
-            # Use timezone-aware UTC timestamp
-            f.write(f"# Last updated: {datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')}\n")
-            f.write("# WARNING: ASN Geo-location is not always precise. This list is based on ASN registration only.\n")
-            f.write("#-----------------------------------------------------------\n")
-            for cidr in cidrs:
-                f.write(f"{cidr}\n")
+            f.write(header)
+            # UTC timestamp straight from gmtime, no datetime object needed
+            f.write(f"{TIMESTAMP_PREFIX}{time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}\n")
+            f.write(body)
         print("Write complete.")
+        return True
     except IOError as e:
         print(f"Fatal: Error writing to file {filename}: {e}", file=sys.stderr)
         sys.exit(1) # Exit with error code if file write fails
@@ -111,20 +248,37 @@ def write_output(cidrs, filename, target_asns):
 if __name__ == "__main__":
     print("Starting IP filter script...")
 
-    # Fetch and filter the data for primary ASNs
+    # Download the table once, filtering against every ASN we need for either list
+    print("\n--- Fetching BGP Table ---")
+    # Only send conditional headers if both lists exist and were built for the current ASN sets;
+    # otherwise a 304 would leave a list missing or stale
+    outputs_current = (output_is_current(OUTPUT_FILENAME_PRIMARY, TARGET_ASNS_PRIMARY)
+                       and output_is_current(OUTPUT_FILENAME_SECONDARY, TARGET_ASNS_SECONDARY))
+    cidrs_by_asn, validators = fetch_and_filter(TARGET_ASNS_PRIMARY | TARGET_ASNS_SECONDARY, conditional=outputs_current)
+    if cidrs_by_asn is None:
+        print("Output files left unchanged.")
+        print("\nScript finished.")
+        sys.exit(0)
+
     print("\n--- Processing Primary ASNs ---")
-    filtered_data_primary = fetch_and_filter(TARGET_ASNS_PRIMARY)
+    outputs_written = False
+    filtered_data_primary = merge_asn_cidrs(cidrs_by_asn, TARGET_ASNS_PRIMARY)
     if filtered_data_primary:
-        write_output(filtered_data_primary, OUTPUT_FILENAME_PRIMARY, TARGET_ASNS_PRIMARY)
+        outputs_written |= write_output(filtered_data_primary, OUTPUT_FILENAME_PRIMARY, TARGET_ASNS_PRIMARY)
     else:
         print(f"Warning: No matching CIDRs found or data fetch issue occurred for primary ASNs {TARGET_ASNS_PRIMARY}. Output file '{OUTPUT_FILENAME_PRIMARY}' will not be updated or created.")
 
-    # Fetch and filter the data for secondary ASNs
     print("\n--- Processing Secondary ASNs ---")
-    filtered_data_secondary = fetch_and_filter(TARGET_ASNS_SECONDARY)
+    filtered_data_secondary = merge_asn_cidrs(cidrs_by_asn, TARGET_ASNS_SECONDARY)
     if filtered_data_secondary:
-        write_output(filtered_data_secondary, OUTPUT_FILENAME_SECONDARY, TARGET_ASNS_SECONDARY)
+        outputs_written |= write_output(filtered_data_secondary, OUTPUT_FILENAME_SECONDARY, TARGET_ASNS_SECONDARY)
     else:
         print(f"Warning: No matching CIDRs found or data fetch issue occurred for secondary ASNs {TARGET_ASNS_SECONDARY}. Output file '{OUTPUT_FILENAME_SECONDARY}' will not be updated or created.")
 
+    # Record validators only after a list was actually rewritten: a failed run retries in full,
+    # and a table change that leaves both lists alone doesn't produce a validator-only commit
+    if outputs_written:
+        for filename, value in validators.items():
+            write_validator(filename, value)
+
     print("\nScript finished.")